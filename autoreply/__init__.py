@@ -11,11 +11,18 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-from typing import Dict, List, Type
+from typing import Awaitable, Callable, Dict, List, Set, Tuple, Type
 
 from maubot import MessageEvent, Plugin
 from maubot.handlers import event
-from mautrix.types import EventType, MessageType, RoomID, TextMessageEventContent
+from mautrix.errors import MNotFound
+from mautrix.types import (
+    AccountDataEvent,
+    EventType,
+    MessageType,
+    RoomID,
+    TextMessageEventContent,
+)
 from mautrix.util.async_db import UpgradeTable
 from mautrix.util.config import BaseProxyConfig
 
@@ -28,11 +35,25 @@ class AutoReplyBot(Plugin):
     management_room: RoomID
     # The class to use for interacting with the database.
     store: AutoReplyBotStore
+    # The IDs of the rooms the current user considers DMs, as per their m.direct
+    # account data.
+    _direct_rooms: Set[RoomID]
+    # The handlers for the commands that can be sent into the management room.
+    _commands: Dict[str, Callable[[MessageEvent], Awaitable[None]]]
+    # The body of the message to auto-reply with, as read from the config.
+    _reply_message: str
 
     async def start(self) -> None:
         """Set up the bot. This method is called by maubot at instance startup."""
         # Load the config.
-        self.config.load_and_update()
+        self._load_config()
+
+        # Register the commands the user can send into the management room.
+        self._commands = {
+            "!clear": self._cmd_clear,
+            "!away": self._cmd_away,
+            "!back": self._cmd_back,
+        }
 
         # Set up the store.
         self.store = AutoReplyBotStore(
@@ -40,14 +61,34 @@ class AutoReplyBot(Plugin):
             user_id=self.client.mxid,
         )
 
-        # Look for an ID for the management room, or create it if it doesn't already
-        # exist.
-        management_room = await self.store.get_management_room()
+        # Populate the store's in-memory caches, so we don't need to hit the database
+        # when handling messages. This also looks for an ID for the management room.
+        management_room = await self.store.load()
+
+        # Create the management room if it doesn't already exist.
         if management_room is None:
             self.management_room = await self._create_management_room()
         else:
             self.management_room = RoomID(management_room)
 
+        # Load the list of DMs. This list is then kept up to date by handle_direct.
+        try:
+            data = await self.client.get_account_data(EventType.DIRECT)
+        except MNotFound:
+            data = {}
+        self._direct_rooms = self._flatten_direct_rooms(data)
+
+    async def on_external_config_update(self) -> None:
+        """Reload the config. This method is called by maubot when the config is
+        updated.
+        """
+        self._load_config()
+
+    def _load_config(self) -> None:
+        """Load the config, and cache the values used when handling messages."""
+        self.config.load_and_update()
+        self._reply_message = self.config["message"]
+
     @classmethod
     def get_config_class(cls) -> Type[BaseProxyConfig]:
         """Returns the class to use to handle hot reloads of the configuration."""
@@ -65,7 +106,8 @@ class AutoReplyBot(Plugin):
         and name, and end-to-end encryption enabled.
 
         Returns:
-            The ID of the room that's been created.
+            The ID of the room to use as the management room. This is the room that's
+            been created, unless another one has been stored concurrently.
         """
         room_id = await self.client.create_room(
             name=self.config["room"]["name"],
@@ -85,9 +127,7 @@ class AutoReplyBot(Plugin):
             ],
         )
 
-        await self.store.store_management_room(room_id)
-
-        return room_id
+        return RoomID(await self.store.store_management_room(room_id))
 
     @event.on(EventType.ROOM_MESSAGE)
     async def handle_message(self, evt: MessageEvent) -> None:
@@ -96,19 +136,48 @@ class AutoReplyBot(Plugin):
         Args:
             evt: The event to handle.
         """
+        # Most messages are received while the user isn't away, and outside of the
+        # management room. There's nothing to do with these, so discard them before doing
+        # anything else.
+        if evt.room_id != self.management_room and not self.store.is_away_cached():
+            return
+
         # If the message has been sent to the management room, check if this is a command
-        # we might know. Otherwise, send an automated reply if needed.
+        # we might know. Commands are sent from the current user's account, so this must
+        # happen before filtering out our own messages.
         if evt.room_id == self.management_room:
             await self._handle_management_command(evt)
-        else:
+        # We don't want to reply to messages we sent.
+        elif evt.sender != self.client.mxid:
+            # Send an automated reply if needed.
             await self._auto_reply(evt)
 
-    async def _is_direct(self, room_id: RoomID) -> bool:
-        """Look through the current user's account data to check if the given room is a
-        DM.
+    @event.on(EventType.DIRECT)
+    async def handle_direct(self, evt: AccountDataEvent) -> None:
+        """Handle an update to the current user's m.direct account data, and update the
+        in-memory list of DMs accordingly.
 
-        TODO: Maybe we can cache this information and manage the invalidation by
-            registering a handler for account data events.
+        Args:
+            evt: The account data event to handle.
+        """
+        self._direct_rooms = self._flatten_direct_rooms(evt.content)
+
+    @staticmethod
+    def _flatten_direct_rooms(data: Dict[str, List[str]]) -> Set[RoomID]:
+        """Turn the content of an m.direct account data event into a set of room IDs.
+
+        Args:
+            data: The content of the account data event, which maps user IDs to the
+                list of IDs of the DMs the current user has with them.
+
+        Returns:
+            The IDs of all the rooms mentioned in the account data.
+        """
+        return {RoomID(room) for rooms in data.values() for room in rooms}
+
+    def _is_direct(self, room_id: RoomID) -> bool:
+        """Check if the given room is a DM, according to the current user's account
+        data.
 
         Args:
             room_id: The room ID to check.
@@ -116,13 +185,7 @@ class AutoReplyBot(Plugin):
         Returns:
             True if the room is a DM, False otherwise.
         """
-        data: Dict[str, List[str]] = await self.client.get_account_data("m.direct")
-        for _, rooms in data.items():
-            for room in rooms:
-                if room == room_id:
-                    return True
-
-        return False
+        return room_id in self._direct_rooms
 
     async def _auto_reply(self, evt: MessageEvent) -> None:
         """Check if we want to auto-reply to the given message event, and send an
@@ -131,30 +194,32 @@ class AutoReplyBot(Plugin):
         Args:
             evt: The event to maybe reply to.
         """
-        if (
-            # We don't want to reply to messages we sent.
-            evt.sender != self.client.mxid
-            # We only want to auto-reply if the user is away.
-            and await self.store.is_away()
-            # We only want to auto-reply once per room.
-            and await self.store.get_message_id_in_room(evt.room_id) is None
-            # We only want to auto-reply in DMs.
-            and await self._is_direct(evt.room_id)
-        ):
-            # Send the reply.
-            await evt.reply(
-                content=TextMessageEventContent(
-                    msgtype=MessageType.TEXT,
-                    body=self.config["message"],
-                ),
-            )
+        # The checks below are all answered from in-memory state, so discarding a
+        # message doesn't require awaiting anything. handle_message already made sure
+        # the user is away.
+
+        # We only want to auto-reply in DMs.
+        if not self._is_direct(evt.room_id):
+            return
+
+        # We only want to auto-reply once per room.
+        if self.store.has_replied_in_room(evt.room_id):
+            return
+
+        # Send the reply.
+        await evt.reply(
+            content=TextMessageEventContent(
+                msgtype=MessageType.TEXT,
+                body=self._reply_message,
+            ),
+        )
 
-            # Store that we've replied to a message in this room, so we don't do it again
-            # until the user comes back.
-            await self.store.store_message(
-                event_id=evt.event_id,
-                room_id=evt.room_id,
-            )
+        # Store that we've replied to a message in this room, so we don't do it again
+        # until the user comes back.
+        await self.store.store_message(
+            event_id=evt.event_id,
+            room_id=evt.room_id,
+        )
 
     async def _handle_management_command(self, evt: MessageEvent) -> None:
         """Handles commands in the management room.
@@ -162,52 +227,91 @@ class AutoReplyBot(Plugin):
         Args:
             evt: The event to check for a command and reply to.
         """
-        if evt.content.body.startswith("!clear"):
-            # !clear is meant as a development tool to clear the database tracking
-            # messages we've reacted to (and thus preventing multiple auto-replies to be
-            # sent into the same room).
-            await self.store.clear_messages()
-            await evt.reply("Cleared messages")
-        if evt.content.body.startswith("!away"):
-            # !away is the command the user uses to mark themselves as away, which turns
-            # on auto-reply.
-            await self.store.update_away_state(is_away=True)
-            await evt.reply("Your status has been updated. Have a nice break!")
-        if evt.content.body.startswith("!back"):
-            # !back is the command the user uses to mark themselves as back/not away. This
-            # generates and sends a summary of all the messages they've missed while away,
-            # and also clears them from the database (so that the database is clean when
-            # the user goes away again).
-            await self.store.update_away_state(is_away=False)
-            reply_content = "Your status has been updated. Welcome back!\n\n"
-            # Send a summary of the messages the user has missed, if any.
-            reply_content += await self._generate_missed_messages_summary()
+        words = evt.content.body.split(None, 1)
+        if not words:
+            return
+
+        handler = self._commands.get(words[0])
+        if handler is not None:
+            await handler(evt)
+
+    async def _cmd_clear(self, evt: MessageEvent) -> None:
+        """Handles the !clear command.
+
+        !clear is meant as a development tool to clear the database tracking messages
+        we've reacted to (and thus preventing multiple auto-replies to be sent into the
+        same room).
+
+        Args:
+            evt: The event containing the command.
+        """
+        await self.store.clear_messages()
+        await evt.reply("Cleared messages")
+
+    async def _cmd_away(self, evt: MessageEvent) -> None:
+        """Handles the !away command.
+
+        !away is the command the user uses to mark themselves as away, which turns on
+        auto-reply.
+
+        Args:
+            evt: The event containing the command.
+        """
+        await self.store.update_away_state(is_away=True)
+        await evt.reply("Your status has been updated. Have a nice break!")
+
+    async def _cmd_back(self, evt: MessageEvent) -> None:
+        """Handles the !back command.
+
+        !back is the command the user uses to mark themselves as back/not away. This
+        generates and sends a summary of all the messages they've missed while away, and
+        also clears them from the database (so that the database is clean when the user
+        goes away again).
+
+        Args:
+            evt: The event containing the command.
+        """
+        await self.store.update_away_state(is_away=False)
+        # Retrieve and clear the list of outstanding missed messages. This must happen
+        # after the away state is updated, otherwise a message arriving in between
+        # would get a second auto-reply.
+        messages = await self.store.pop_missed_messages()
+        reply_content = "Your status has been updated. Welcome back!\n\n"
+        # Send a summary of the messages the user has missed, if any.
+        reply_content += self._generate_missed_messages_summary(messages)
+        try:
             await evt.reply(
                 content=reply_content,
                 markdown=True,
             )
-            # Clear the list of outstanding missed messages.
-            await self.store.clear_messages()
+        except Exception:
+            # The missed messages have already been removed from the database, so put
+            # them back to avoid losing them if the summary couldn't be sent.
+            await self.store.restore_missed_messages(messages)
+            raise
 
-    async def _generate_missed_messages_summary(self) -> str:
+    def _generate_missed_messages_summary(self, messages: List[Tuple[str, str]]) -> str:
         """Generates a summary of the messages the user has missed, if any.
 
+        Args:
+            messages: The missed messages, as returned by
+                AutoReplyBotStore.pop_missed_messages.
+
         Returns:
             The text summary to send back to the user.
         """
-        messages = await self.store.get_missed_messages()
         if len(messages) == 0:
             # If there isn't any missed message, just return now.
             return "You haven't missed any message while you were away."
 
         # If there are messages to report, iterate over them to format them nicely.
-        summary = (
-            "While you were away, you have missed messages in the following DM(s):\n"
+        header = "While you were away, you have missed messages in the following DM(s):"
+        entries = "\n".join(
+            f"* {self._generate_room_entry(room_id, event_id)}"
+            for room_id, event_id in messages
         )
-        for room_id, event_id in messages:
-            summary += f"\n* {self._generate_room_entry(room_id, event_id)}"
 
-        return summary
+        return f"{header}\n\n{entries}"
 
     def _generate_room_entry(self, room_id: str, event_id: str) -> str:
         """Generates the entry for a given room in the missed messages summary.
@@ -221,6 +325,7 @@ class AutoReplyBot(Plugin):
         """
         # We make a link of the room ID so that compatible clients can pillify it. We
         # don't need to provide `via` parameters since the user is already in these rooms.
-        entry = f"[{room_id}](https://matrix.to/#/{room_id})"
-        entry += f" ([view message](https://matrix.to/#/{room_id}/{event_id}))"
-        return entry
+        return (
+            f"[{room_id}](https://matrix.to/#/{room_id})"
+            f" ([view message](https://matrix.to/#/{room_id}/{event_id}))"
+        )
@@ -11,7 +11,7 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-from typing import List, Optional, Tuple
+from typing import List, Optional, Set, Tuple
 
 from mautrix.types import RoomID
 from mautrix.util.async_db import Connection, Database, UpgradeTable
@@ -50,6 +50,60 @@ async def schema_v1(conn: Connection) -> None:
     )
 
 
+@upgrade_table.register(description="Index missed messages by user and room")
+async def schema_v2(conn: Connection) -> None:
+    """Make (user_id, room_id) the primary key of autoreply_messages, since all of the
+    queries on this table filter on the user ID.
+    """
+    await conn.execute(
+        """CREATE TABLE autoreply_messages_new (
+            user_id  TEXT NOT NULL,
+            room_id  TEXT NOT NULL,
+            event_id TEXT NOT NULL,
+            PRIMARY KEY (user_id, room_id)
+        )
+        """
+    )
+
+    await conn.execute(
+        """INSERT INTO autoreply_messages_new (user_id, room_id, event_id)
+            SELECT user_id, room_id, event_id FROM autoreply_messages
+        """
+    )
+
+    await conn.execute("DROP TABLE autoreply_messages")
+    await conn.execute(
+        "ALTER TABLE autoreply_messages_new RENAME TO autoreply_messages"
+    )
+
+
+# The SQL queries used by the store. asyncpg already caches prepared statements on each
+# pooled connection, keyed on the query string, so we only need to make sure we always
+# send the exact same string for a given query.
+_SQL_GET_MGMT_ROOM = "SELECT room_id FROM autoreply_management_rooms WHERE user_id = $1"
+_SQL_STORE_MGMT_ROOM = """
+    INSERT INTO autoreply_management_rooms(user_id, room_id) VALUES($1, $2)
+    ON CONFLICT(user_id) DO NOTHING
+    RETURNING room_id
+"""
+_SQL_LIST_REPLIED_ROOMS = "SELECT room_id FROM autoreply_messages WHERE user_id = $1"
+_SQL_STORE_MESSAGE = """
+    INSERT INTO autoreply_messages(event_id, room_id, user_id) VALUES($1, $2, $3)
+"""
+_SQL_CLEAR_MESSAGES = "DELETE FROM autoreply_messages WHERE user_id = $1"
+_SQL_POP_MISSED_MESSAGES = """
+    DELETE FROM autoreply_messages WHERE user_id = $1 RETURNING room_id, event_id
+"""
+_SQL_GET_AWAY = "SELECT is_away FROM autoreply_user_away WHERE user_id = $1"
+_SQL_UPDATE_AWAY = """
+    INSERT INTO autoreply_user_away(user_id, is_away)
+    VALUES($1, $2)
+    ON CONFLICT(user_id) DO
+        UPDATE SET is_away = EXCLUDED.is_away
+        WHERE autoreply_user_away.user_id = EXCLUDED.user_id
+"""
+
+
 class AutoReplyBotStore:
     def __init__(self, database: Database, user_id: str) -> None:
         self.database = database
@@ -57,37 +111,73 @@ class AutoReplyBotStore:
         # The Matrix user ID associated with the current instance.
         self.user_id = user_id
 
+        # In-memory cache of the user's away state, so we don't need to hit the
+        # database for every incoming message. Populated by load.
+        self._is_away = False
+
+        # In-memory cache of the IDs of the rooms we've already auto-replied in, so we
+        # don't need to hit the database to check it. Populated by load.
+        self._replied_rooms: Set[str] = set()
+
+    async def load(self) -> Optional[str]:
+        """Populate the in-memory caches from the database, and retrieve the ID of the
+        management room for the current user. Must be called before using the store to
+        handle incoming messages.
+
+        All the queries are run using a single database connection.
+
+        Returns:
+            The room ID of the management room if one exists, None otherwise.
+        """
+        async with self.database.acquire() as conn:
+            management_room = await conn.fetchval(_SQL_GET_MGMT_ROOM, self.user_id)
+            is_away = await conn.fetchval(_SQL_GET_AWAY, self.user_id)
+            rows = await conn.fetch(_SQL_LIST_REPLIED_ROOMS, self.user_id)
+
+        # If the user has no state set, we consider them as not away.
+        self._is_away = bool(is_away)
+        self._replied_rooms = {row["room_id"] for row in rows}
+
+        return management_room
+
     async def get_management_room(self) -> Optional[str]:
         """Retrieve the ID of the management room for the current user, if any.
 
         Returns:
             The room ID of the management room if one exists, None otherwise.
         """
-        sql = "SELECT room_id FROM autoreply_management_rooms WHERE user_id = $1"
-        return await self.database.fetchval(sql, self.user_id)
+        return await self.database.fetchval(_SQL_GET_MGMT_ROOM, self.user_id)
 
-    async def store_management_room(self, room_id: RoomID) -> None:
-        """Store the given room ID as the management room for the current user.
+    async def store_management_room(self, room_id: RoomID) -> str:
+        """Store the given room ID as the management room for the current user, unless
+        one has already been stored for them.
 
         Args:
             room_id: The room ID to store.
+
+        Returns:
+            The ID of the management room for the current user, which might differ from
+            the provided room ID if another one has been stored concurrently.
         """
-        sql = "INSERT INTO autoreply_management_rooms(user_id, room_id) VALUES($1, $2)"
-        await self.database.execute(sql, self.user_id, room_id)
+        stored_room_id = await self.database.fetchval(
+            _SQL_STORE_MGMT_ROOM, self.user_id, room_id
+        )
+        if stored_room_id is None:
+            # Another room has been stored before us, use that one instead.
+            stored_room_id = await self.get_management_room()
+
+        return stored_room_id
 
-    async def get_message_id_in_room(self, room_id: RoomID) -> Optional[str]:
-        """Retrieve the ID of the first missed event in the given room, if any.
+    def has_replied_in_room(self, room_id: RoomID) -> bool:
+        """Check if we've already auto-replied to a message in the given room.
 
         Args:
             room_id: The ID of the room to check.
 
         Returns:
-            The ID of the first missed event in the room if any, None otherwise.
+            True if a missed message has been stored for this room, False otherwise.
         """
-        sql = """
-            SELECT event_id FROM autoreply_messages WHERE room_id = $1 AND user_id = $2
-        """
-        return await self.database.fetchval(sql, room_id, self.user_id)
+        return room_id in self._replied_rooms
 
     async def store_message(self, event_id: str, room_id: str) -> None:
         """Stores the given event ID as the first missed event in the given room.
@@ -96,28 +186,38 @@ class AutoReplyBotStore:
             event_id: The event ID to store.
             room_id: The ID of the room the event was sent into.
         """
-        sql = """
-            INSERT INTO autoreply_messages(event_id, room_id, user_id) VALUES($1, $2, $3)
-        """
-        await self.database.execute(sql, event_id, room_id, self.user_id)
+        await self.database.execute(_SQL_STORE_MESSAGE, event_id, room_id, self.user_id)
+        self._replied_rooms.add(room_id)
 
     async def clear_messages(self) -> None:
         """Remove all missed messages for the current user."""
-        sql = "DELETE FROM autoreply_messages WHERE user_id = $1"
-        await self.database.execute(sql, self.user_id)
+        await self.database.execute(_SQL_CLEAR_MESSAGES, self.user_id)
+        self._replied_rooms.clear()
+
+    async def pop_missed_messages(self) -> List[Tuple[str, str]]:
+        """Retrieve a summary of missed messages, and remove them from the database.
 
-    async def get_missed_messages(self) -> List[Tuple[str, str]]:
-        """Retrieve a summary of missed messages.
+        Since the messages are removed as soon as they're retrieved, callers that fail to
+        report them to the user should put them back with restore_missed_messages.
 
         Returns:
             A list of rooms containing missed messages. Each room is represented by a
             tuple where the first element is the room's ID, and the second element is the
             event ID of the first missed message in the room.
         """
-        sql = "SELECT room_id, event_id FROM autoreply_messages WHERE user_id = $1"
-        rows = await self.database.fetch(sql, self.user_id)
+        rows = await self.database.fetch(_SQL_POP_MISSED_MESSAGES, self.user_id)
+        self._replied_rooms.clear()
         return [(row["room_id"], row["event_id"]) for row in rows]
 
+    async def restore_missed_messages(self, messages: List[Tuple[str, str]]) -> None:
+        """Store back missed messages previously returned by pop_missed_messages.
+
+        Args:
+            messages: The missed messages to store, as returned by pop_missed_messages.
+        """
+        for room_id, event_id in messages:
+            await self.store_message(event_id=event_id, room_id=room_id)
+
     async def update_away_state(self, is_away: bool) -> None:
         """Update the away state (away/back) of the current user.
 
@@ -125,26 +225,16 @@ class AutoReplyBotStore:
             is_away: A boolean indicating whether the user is away (True = away,
                 False = not away).
         """
-        sql = """
-            INSERT INTO autoreply_user_away(user_id, is_away)
-            VALUES($1, $2)
-            ON CONFLICT(user_id) DO
-                UPDATE SET is_away = EXCLUDED.is_away
-                WHERE autoreply_user_away.user_id = EXCLUDED.user_id
-        """
-        await self.database.execute(sql, self.user_id, is_away)
+        await self.database.execute(_SQL_UPDATE_AWAY, self.user_id, is_away)
+        self._is_away = is_away
 
-    async def is_away(self) -> bool:
-        """Check if the user is currently marked as away.
+    def is_away_cached(self) -> bool:
+        """Check if the user is currently marked as away, without querying the database.
 
-        If the user has no state set, we consider them as not away.
+        The cache must have been populated beforehand with a call to load. If it hasn't,
+        the user is considered as not away.
 
         Returns:
             True if the user is away, False otherwise.
         """
-        sql = "SELECT is_away FROM autoreply_user_away WHERE user_id = $1"
-        ret = await self.database.fetchval(sql, self.user_id)
-        if ret is None:
-            return False
-
-        return ret
+        return self._is_away